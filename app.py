@@ -6,19 +6,67 @@ This app provides API endpoints for:
 """
 
 import os
-import json
+import atexit
+import base64
+import logging
+import queue
+import orjson
 import re
+import hashlib
+import threading
+import uuid
 import requests
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from datetime import datetime
+from logging.handlers import QueueHandler, QueueListener
 from pathlib import Path
-from flask import Flask, request, jsonify, render_template
+from flask import Flask, Response, request, jsonify, stream_with_context
+from flask.json.provider import DefaultJSONProvider
+from werkzeug.exceptions import HTTPException, RequestEntityTooLarge
 from dotenv import load_dotenv
 from openai import AzureOpenAI
 
 # Load environment variables
 load_dotenv()
 
+# Logging: handlers enqueue records and a background listener thread does the
+# actual stream I/O, so request threads never block on stdout
+logger = logging.getLogger("tf-agent")
+logger.setLevel(os.getenv("LOG_LEVEL", "INFO").upper())
+logger.propagate = False
+
+_log_handler = logging.StreamHandler()
+_log_handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(message)s"))
+_log_queue = queue.SimpleQueue()
+logger.addHandler(QueueHandler(_log_queue))
+log_listener = QueueListener(_log_queue, _log_handler)
+log_listener.start()
+atexit.register(log_listener.stop)
+
+
+class OrjsonProvider(DefaultJSONProvider):
+    """Flask JSON provider backed by orjson (serializes straight to bytes)."""
+    
+    def dumps(self, obj, **kwargs) -> str:
+        return orjson.dumps(obj, default=self.default).decode()
+    
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+    
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        option = orjson.OPT_INDENT_2 if self._app.debug else 0
+        return self._app.response_class(
+            orjson.dumps(obj, default=self.default, option=option),
+            mimetype=self.mimetype
+        )
+
+
 app = Flask(__name__)
+app.json = OrjsonProvider(app)
 
 # =============================================================================
 # CONFIGURATION
@@ -30,11 +78,39 @@ AZURE_OPENAI_API_KEY = os.getenv("AZURE_OPENAI_API_KEY")
 AZURE_OPENAI_DEPLOYMENT = os.getenv("AZURE_OPENAI_DEPLOYMENT", "gpt-4o")
 AZURE_OPENAI_API_VERSION = os.getenv("AZURE_OPENAI_API_VERSION", "2024-08-01-preview")
 
+# Worker threads for saving files / creating PRs off the request thread
+BACKGROUND_WORKERS = int(os.getenv("BACKGROUND_WORKERS", 4))
+
+# Optional routing hint (e.g. "tf-agent-v4") so repeated requests reach the
+# server holding the cached system prompt prefix. Off by default: API versions
+# that do not know prompt_cache_key reject the request with a 400. Change the
+# value when TERRAFORM_SYSTEM_PROMPT changes.
+AZURE_OPENAI_PROMPT_CACHE_KEY = os.getenv("AZURE_OPENAI_PROMPT_CACHE_KEY", "")
+
+# Upper bound for the "variants" option of /api/generate
+MAX_VARIANTS = 4
+
+# Largest completion budget; truncated generations are retried once with it
+MAX_COMPLETION_TOKENS = 4000
+
+# Number of recent generations kept in memory for identical prompts (0 disables)
+GENERATION_CACHE_SIZE = int(os.getenv("GENERATION_CACHE_SIZE", 256))
+
 # GitHub Configuration
 GITHUB_TOKEN = os.getenv("GITHUB_TOKEN")
 GITHUB_REPO_URL = os.getenv("GITHUB_REPO_URL")
 OUTPUT_DIRECTORY = os.getenv("OUTPUT_DIRECTORY", "generated_terraform")
 
+# Request size limits (bodies over MAX_REQUEST_BYTES are rejected by Flask)
+MAX_REQUEST_BYTES = 1_048_576
+MAX_TERRAFORM_CODE_CHARS = 512_000
+app.config['MAX_CONTENT_LENGTH'] = MAX_REQUEST_BYTES
+
+# Owner/repo parsed once from GITHUB_REPO_URL (None if missing or invalid)
+GITHUB_REPO_PATTERN = re.compile(r'https://github\.com/([^/]+)/([^/\.]+)')
+_repo_match = GITHUB_REPO_PATTERN.match(GITHUB_REPO_URL or "")
+GITHUB_OWNER, GITHUB_REPO = _repo_match.groups() if _repo_match else (None, None)
+
 # Initialize Azure OpenAI client (optional)
 openai_client = None
 if AZURE_OPENAI_ENDPOINT and AZURE_OPENAI_API_KEY:
@@ -44,6 +120,29 @@ if AZURE_OPENAI_ENDPOINT and AZURE_OPENAI_API_KEY:
         api_version=AZURE_OPENAI_API_VERSION
     )
 
+# Background jobs (job_id -> Future), oldest dropped past MAX_TRACKED_JOBS
+background_executor = ThreadPoolExecutor(max_workers=BACKGROUND_WORKERS)
+background_jobs = OrderedDict()
+background_jobs_lock = threading.Lock()
+MAX_TRACKED_JOBS = 1000
+
+# Shared GitHub API session (keep-alive + retry on transient errors)
+github_session = requests.Session()
+github_session.headers.update({"Accept": "application/vnd.github.v3+json"})
+if GITHUB_TOKEN:
+    github_session.headers["Authorization"] = f"Bearer {GITHUB_TOKEN}"
+github_session.mount("https://", HTTPAdapter(
+    pool_connections=8,
+    pool_maxsize=16,
+    max_retries=Retry(
+        total=3,
+        backoff_factor=0.5,
+        status_forcelist=[429, 502, 503, 504],
+        allowed_methods=["GET", "PUT", "POST"],
+        raise_on_status=False
+    )
+))
+
 # =============================================================================
 # TERRAFORM GENERATION PROMPT
 # =============================================================================
@@ -106,65 +205,311 @@ provider "azurerm" {
 Use format: {prefix}-{resource_type}-{environment}
 Example: tfgen-storage-prod
 
+## VARIABLE DEFINITIONS
+```hcl
+variable "subscription_id" {
+  description = "Azure subscription ID to deploy into"
+  type        = string
+}
+
+variable "location" {
+  description = "Azure region for all resources"
+  type        = string
+  default     = "eastus"
+}
+
+variable "resource_group_name" {
+  description = "Name of the existing resource group to deploy into"
+  type        = string
+}
+
+variable "environment" {
+  description = "Deployment environment (dev, test, prod)"
+  type        = string
+  default     = "dev"
+
+  validation {
+    condition     = contains(["dev", "test", "prod"], var.environment)
+    error_message = "environment must be one of: dev, test, prod."
+  }
+}
+
+variable "prefix" {
+  description = "Short prefix used in resource names"
+  type        = string
+  default     = "tfgen"
+
+  validation {
+    condition     = can(regex("^[a-z0-9]{2,10}$", var.prefix))
+    error_message = "prefix must be 2-10 lowercase letters or digits."
+  }
+}
+
+variable "tags" {
+  description = "Additional tags applied to every resource"
+  type        = map(string)
+  default     = {}
+}
+```
+
+## MAIN PATTERNS
+```hcl
+data "azurerm_resource_group" "main" {
+  name = var.resource_group_name
+}
+
+locals {
+  common_tags = merge(var.tags, {
+    environment  = var.environment
+    managed_by   = "terraform"
+    generated_by = "copilot-terraform-agent"
+  })
+}
+
+resource "azurerm_storage_account" "main" {
+  name                     = substr(replace("${var.prefix}st${var.environment}", "-", ""), 0, 24)
+  resource_group_name      = data.azurerm_resource_group.main.name
+  location                 = var.location
+  account_tier             = "Standard"
+  account_replication_type = "LRS"
+  min_tls_version          = "TLS1_2"
+  tags                     = local.common_tags
+}
+```
+- Reference the resource group through the data source; never hardcode its name
+- Resources whose names cannot contain hyphens (storage accounts, container registries) must strip them and respect the service's length limits
+- Use secure defaults: TLS 1.2 minimum, HTTPS only, managed identities instead of access keys, public network access disabled where the service supports it
+- Never put secrets in variable defaults
+
+## OUTPUT PATTERNS
+```hcl
+output "storage_account_id" {
+  description = "Resource ID of the storage account"
+  value       = azurerm_storage_account.main.id
+}
+
+output "storage_account_primary_key" {
+  description = "Primary access key of the storage account"
+  value       = azurerm_storage_account.main.primary_access_key
+  sensitive   = true
+}
+```
+- Output the IDs, names and endpoints downstream configuration will need
+- Mark every key, password or connection string output as sensitive = true
+
+## BLOCK SEPARATION
+- providers.tf: only the terraform {} and provider blocks
+- variables.tf: only variable blocks
+- main.tf: data sources, locals and resources
+- outputs.tf: only output blocks
+Each code block becomes its own file, so never mix these block types in one code block.
+
+The examples above show the expected style; adapt them to the user's request instead of copying them verbatim.
+
+## END MARKER
+After the last code block, output the line ### END and nothing else.
+
 Generate clean, production-ready Terraform code based on the user's requirements."""
 
+# Stop sequence matching the END MARKER instruction above (not included in the output)
+TERRAFORM_STOP_SEQUENCE = "### END"
+
 
 # =============================================================================
 # HELPER FUNCTIONS
 # =============================================================================
 
+# Compiled once at import; used on every generate/commit request
+HCL_BLOCK_PATTERN = re.compile(r'```(?:hcl|terraform)?\s*\n(.*?)```', re.DOTALL)
+
+# Output files, in the order they are returned and written
+TERRAFORM_FILES = ('providers.tf', 'variables.tf', 'main.tf', 'outputs.tf')
+
+# First match wins; anything unmatched goes to main.tf
+BLOCK_CATEGORIES = (
+    (('terraform {', 'provider "'), 'providers.tf'),
+    (('variable "',), 'variables.tf'),
+    (('output "',), 'outputs.tf'),
+)
+
+
 def parse_terraform_blocks(terraform_code: str) -> dict:
     """Extract Terraform code blocks from the response."""
-    blocks = {
-        'providers.tf': '',
-        'variables.tf': '',
-        'main.tf': '',
-        'outputs.tf': ''
-    }
+    blocks = dict.fromkeys(TERRAFORM_FILES, '')
     
-    # Find all HCL code blocks
-    pattern = r'```(?:hcl|terraform)?\s*\n(.*?)```'
-    matches = re.findall(pattern, terraform_code, re.DOTALL)
-    
-    if not matches:
-        # If no code blocks, treat entire response as main.tf
+    # No fences at all: skip the regex and treat entire response as main.tf
+    if '```' not in terraform_code:
         blocks['main.tf'] = terraform_code.strip()
         return blocks
     
-    # Categorize blocks based on content
-    for i, block in enumerate(matches):
-        block = block.strip()
+    # Categorize HCL code blocks as they are found (collected per file, joined once)
+    matched = False
+    written = {}
+    for match in HCL_BLOCK_PATTERN.finditer(terraform_code):
+        matched = True
+        block = match.group(1).strip()
         if not block:
             continue
-            
-        if 'terraform {' in block or 'provider "' in block:
-            blocks['providers.tf'] += block + '\n\n'
-        elif 'variable "' in block:
-            blocks['variables.tf'] += block + '\n\n'
-        elif 'output "' in block:
-            blocks['outputs.tf'] += block + '\n\n'
+        
+        for markers, filename in BLOCK_CATEGORIES:
+            if any(marker in block for marker in markers):
+                break
         else:
-            blocks['main.tf'] += block + '\n\n'
+            filename = 'main.tf'
+        written.setdefault(filename, []).append(block)
     
-    # Clean up
-    for key in blocks:
-        blocks[key] = blocks[key].strip()
+    if not matched:
+        # If no code blocks, treat entire response as main.tf
+        blocks['main.tf'] = terraform_code.strip()
+        return blocks
+    
+    # Only files that received blocks need assembling; the rest stay ''
+    for filename, parts in written.items():
+        blocks[filename] = '\n\n'.join(parts)
     
     return blocks
 
 
+def estimate_max_tokens(prompt: str) -> int:
+    """Scale the completion budget with the request instead of always asking for the maximum."""
+    return min(MAX_COMPLETION_TOKENS, max(1500, 400 + 8 * len(prompt)))
+
+
+def completion_chunks(messages: list, max_tokens: int = MAX_COMPLETION_TOKENS, n: int = 1):
+    """
+    Stream n chat completions from Azure OpenAI.
+    
+    Yields (choice index, content delta, finish_reason) tuples; the delta may
+    be empty and finish_reason is None until the choice's final chunk.
+    """
+    # The static system prompt comes first so the provider can cache the prefix
+    extra_body = {"prompt_cache_key": AZURE_OPENAI_PROMPT_CACHE_KEY} if AZURE_OPENAI_PROMPT_CACHE_KEY else None
+    response = openai_client.chat.completions.create(
+        model=AZURE_OPENAI_DEPLOYMENT,
+        messages=messages,
+        temperature=0.3,
+        max_tokens=max_tokens,
+        stop=[TERRAFORM_STOP_SEQUENCE],
+        n=n,
+        stream=True,
+        user=f"tf-{AZURE_OPENAI_DEPLOYMENT}",
+        extra_body=extra_body
+    )
+    for chunk in response:
+        # Azure sends a leading chunk with no choices (content filter results)
+        for choice in chunk.choices:
+            yield choice.index, choice.delta.content or '', choice.finish_reason
+
+
+def complete(messages: list, max_tokens: int, n: int = 1) -> list:
+    """
+    Request n completions in one call and return [(text, finish_reason), ...].
+    
+    If any choice is cut off by the token budget, the call is repeated once
+    with MAX_COMPLETION_TOKENS.
+    """
+    buffers = [[] for _ in range(n)]
+    finish_reasons = [None] * n
+    for index, delta, finish_reason in completion_chunks(messages, max_tokens, n):
+        buffers[index].append(delta)
+        if finish_reason:
+            finish_reasons[index] = finish_reason
+    
+    if "length" in finish_reasons and max_tokens < MAX_COMPLETION_TOKENS:
+        logger.warning("⚠️ Completion truncated at max_tokens=%d, retrying with %d", max_tokens, MAX_COMPLETION_TOKENS)
+        return complete(messages, MAX_COMPLETION_TOKENS, n)
+    
+    return [(''.join(buf), finish_reason) for buf, finish_reason in zip(buffers, finish_reasons)]
+
+
+def incomplete_generation_error(finish_reason) -> str:
+    """Error message for a completion that did not end at the stop sequence."""
+    if finish_reason == "length":
+        return f"Generated Terraform was cut off at {MAX_COMPLETION_TOKENS} tokens; nothing was saved. Try a narrower prompt."
+    return f"Generation did not complete (finish_reason: {finish_reason}); nothing was saved."
+
+
+# In-memory LRU of raw model responses, keyed by generation_cache_key()
+generation_cache = OrderedDict()
+generation_cache_lock = threading.Lock()
+
+
+def generation_cache_key(prompt: str, location: str, resource_group_name: str) -> bytes:
+    """Hash the deployment and normalized request inputs into a cache key."""
+    normalized = ' '.join(prompt.split())
+    key = f"{AZURE_OPENAI_DEPLOYMENT}|{normalized}|{location}|{resource_group_name}"
+    return hashlib.blake2b(key.encode(), digest_size=16).digest()
+
+
+def get_cached_generation(key: bytes):
+    """Return a cached model response (marking it recently used) or None."""
+    with generation_cache_lock:
+        response = generation_cache.get(key)
+        if response is not None:
+            generation_cache.move_to_end(key)
+        return response
+
+
+def cache_generation(key: bytes, response: str, finish_reason: str):
+    """
+    Store a model response, evicting the least recently used entry.
+    
+    Only completions that ended at the stop sequence are kept, so a truncated
+    or filtered reply is never replayed as a cache hit.
+    """
+    if GENERATION_CACHE_SIZE <= 0 or not response or finish_reason != "stop":
+        return
+    with generation_cache_lock:
+        generation_cache[key] = response
+        generation_cache.move_to_end(key)
+        while len(generation_cache) > GENERATION_CACHE_SIZE:
+            generation_cache.popitem(last=False)
+
+
+def store_object(data: bytes) -> Path:
+    """Write data once into the content-addressed store and return its path."""
+    objects_dir = Path(OUTPUT_DIRECTORY) / "_objects"
+    digest = hashlib.blake2b(data, digest_size=16).hexdigest()
+    obj = objects_dir / digest
+    if not obj.exists():
+        objects_dir.mkdir(parents=True, exist_ok=True)
+        # Write under a unique name and rename, so readers never see a partial object.
+        # Objects are read-only: an in-place edit through one link (terraform fmt,
+        # an editor save) would otherwise change every generation sharing it.
+        tmp = objects_dir / f"{digest}.{uuid.uuid4().hex}.tmp"
+        try:
+            tmp.write_bytes(data)
+            os.chmod(tmp, 0o444)
+            os.replace(tmp, obj)
+        except OSError:
+            tmp.unlink(missing_ok=True)
+            raise
+    return obj
+
+
+def link_terraform_file(path: Path, content: str):
+    """Hard-link path to the stored copy of content (plain write if links are unsupported)."""
+    data = content.encode("utf-8")
+    try:
+        obj = store_object(data)
+        # Never write through an existing link; replace it
+        path.unlink(missing_ok=True)
+        os.link(obj, path)
+    except OSError:
+        path.write_bytes(data)
+
+
 def save_terraform_files(blocks: dict, prompt: str) -> str:
     """Save Terraform files to disk."""
     timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-    output_dir = Path(OUTPUT_DIRECTORY) / f"terraform_{timestamp}"
-    output_dir.mkdir(parents=True, exist_ok=True)
+    # Suffix keeps concurrent saves within the same second in separate directories
+    output_dir = Path(OUTPUT_DIRECTORY) / f"terraform_{timestamp}_{uuid.uuid4().hex[:8]}"
+    output_dir.mkdir(parents=True, exist_ok=False)
     
-    # Save each file
+    # Save each file (identical content across generations shares one copy on disk)
     for filename, content in blocks.items():
         if content:
-            file_path = output_dir / filename
-            with open(file_path, 'w') as f:
-                f.write(content)
+            link_terraform_file(output_dir / filename, content)
     
     # Save metadata
     metadata = {
@@ -172,8 +517,7 @@ def save_terraform_files(blocks: dict, prompt: str) -> str:
         "timestamp": timestamp,
         "files": [f for f, c in blocks.items() if c]
     }
-    with open(output_dir / "metadata.json", 'w') as f:
-        json.dump(metadata, f, indent=2)
+    (output_dir / "metadata.json").write_bytes(orjson.dumps(metadata, option=orjson.OPT_INDENT_2))
     
     # Create README
     readme = f"""# Generated Terraform Configuration
@@ -194,8 +538,7 @@ terraform apply
 ## Generated
 {datetime.now().isoformat()}
 """
-    with open(output_dir / "README.md", 'w') as f:
-        f.write(readme)
+    (output_dir / "README.md").write_text(readme, encoding="utf-8")
     
     return str(output_dir)
 
@@ -205,59 +548,87 @@ def create_github_pr(terraform_blocks: dict, prompt: str, branch_name: str = Non
     if not GITHUB_TOKEN or not GITHUB_REPO_URL:
         return {"error": "GitHub not configured"}
     
-    # Parse repo info
-    match = re.match(r'https://github\.com/([^/]+)/([^/\.]+)', GITHUB_REPO_URL)
-    if not match:
+    if not GITHUB_OWNER:
         return {"error": "Invalid GitHub repo URL"}
     
-    owner, repo = match.groups()
-    headers = {
-        "Authorization": f"Bearer {GITHUB_TOKEN}",
-        "Accept": "application/vnd.github.v3+json"
-    }
+    api = f"https://api.github.com/repos/{GITHUB_OWNER}/{GITHUB_REPO}"
     
     try:
         # Get default branch SHA
-        ref_response = requests.get(
-            f"https://api.github.com/repos/{owner}/{repo}/git/ref/heads/main",
-            headers=headers
-        )
+        ref_response = github_session.get(f"{api}/git/ref/heads/main")
         if ref_response.status_code != 200:
             return {"error": "Failed to get main branch"}
         
         base_sha = ref_response.json()["object"]["sha"]
         
-        # Create new branch
         if not branch_name:
             timestamp = datetime.now().strftime("%Y%m%d-%H%M%S")
-            branch_name = f"terraform/copilot-{timestamp}"
+            branch_name = f"terraform/copilot-{timestamp}-{uuid.uuid4().hex[:8]}"
+        
+        folder_name = f"deployments/{branch_name.replace('/', '-')}"
+        # Encode each file once up front so retries resend identical content
+        encoded = {
+            filename: base64.b64encode(content.encode("utf-8")).decode("ascii")
+            for filename, content in terraform_blocks.items() if content
+        }
+        files = list(encoded.items())
         
-        requests.post(
-            f"https://api.github.com/repos/{owner}/{repo}/git/refs",
-            headers=headers,
-            json={"ref": f"refs/heads/{branch_name}", "sha": base_sha}
+        def create_blob(item):
+            filename, content = item
+            return github_session.post(
+                f"{api}/git/blobs",
+                json={"content": content, "encoding": "base64"}
+            )
+        
+        # Upload blobs concurrently, alongside the lookup of the base tree
+        with ThreadPoolExecutor(max_workers=8) as pool:
+            base_commit = pool.submit(github_session.get, f"{api}/git/commits/{base_sha}")
+            blob_responses = list(pool.map(create_blob, files))
+            base_commit_response = base_commit.result()
+        
+        if base_commit_response.status_code != 200:
+            return {"error": "Failed to get main branch commit"}
+        
+        tree = []
+        for (filename, _), response in zip(files, blob_responses):
+            if response.status_code != 201:
+                return {"error": f"Failed to upload {filename}: {response.text}"}
+            tree.append({
+                "path": f"{folder_name}/{filename}",
+                "mode": "100644",
+                "type": "blob",
+                "sha": response.json()["sha"]
+            })
+        
+        # Commit all files at once, then point the new branch at that commit
+        tree_response = github_session.post(
+            f"{api}/git/trees",
+            json={"base_tree": base_commit_response.json()["tree"]["sha"], "tree": tree}
         )
+        if tree_response.status_code != 201:
+            return {"error": f"Failed to create tree: {tree_response.text}"}
         
-        # Create files in the branch
-        folder_name = f"deployments/{branch_name.replace('/', '-')}"
+        commit_response = github_session.post(
+            f"{api}/git/commits",
+            json={
+                "message": f"Add Terraform configuration for {folder_name}",
+                "tree": tree_response.json()["sha"],
+                "parents": [base_sha]
+            }
+        )
+        if commit_response.status_code != 201:
+            return {"error": f"Failed to create commit: {commit_response.text}"}
         
-        for filename, content in terraform_blocks.items():
-            if content:
-                file_path = f"{folder_name}/{filename}"
-                requests.put(
-                    f"https://api.github.com/repos/{owner}/{repo}/contents/{file_path}",
-                    headers=headers,
-                    json={
-                        "message": f"Add {filename}",
-                        "content": __import__('base64').b64encode(content.encode()).decode(),
-                        "branch": branch_name
-                    }
-                )
+        ref_response = github_session.post(
+            f"{api}/git/refs",
+            json={"ref": f"refs/heads/{branch_name}", "sha": commit_response.json()["sha"]}
+        )
+        if ref_response.status_code != 201:
+            return {"error": f"Failed to create branch: {ref_response.text}"}
         
         # Create PR
-        pr_response = requests.post(
-            f"https://api.github.com/repos/{owner}/{repo}/pulls",
-            headers=headers,
+        pr_response = github_session.post(
+            f"{api}/pulls",
             json={
                 "title": f"🤖 Copilot: {prompt[:60]}{'...' if len(prompt) > 60 else ''}",
                 "body": f"## Terraform Infrastructure Request\n\n**Prompt:** {prompt}\n\n---\n\n*Generated by Copilot Terraform Agent*",
@@ -281,6 +652,125 @@ def create_github_pr(terraform_blocks: dict, prompt: str, branch_name: str = Non
         return {"error": str(e)}
 
 
+def persist_and_pr(terraform_blocks: dict, prompt: str, create_pr: bool) -> dict:
+    """Save the files to disk and optionally open a PR for them."""
+    # Save to disk
+    saved_path = save_terraform_files(terraform_blocks, prompt)
+    logger.info("💾 Saved to: %s", saved_path)
+    
+    # Create PR if requested
+    pr_result = {}
+    if create_pr:
+        pr_result = create_github_pr(terraform_blocks, prompt)
+        if pr_result.get('success'):
+            logger.info("✅ PR created: %s", pr_result['pr_url'])
+    
+    return {
+        "saved_path": saved_path,
+        "pr_url": pr_result.get('pr_url'),
+        "pr_number": pr_result.get('pr_number'),
+        "branch_name": pr_result.get('branch_name'),
+        "pr_error": pr_result.get('error')
+    }
+
+
+def submit_job(fn, *args) -> str:
+    """Run fn(*args) on the background executor and return its job id."""
+    job_id = uuid.uuid4().hex
+    future = background_executor.submit(fn, *args)
+    with background_jobs_lock:
+        background_jobs[job_id] = future
+        while len(background_jobs) > MAX_TRACKED_JOBS:
+            background_jobs.popitem(last=False)
+    return job_id
+
+
+def finish_generation(terraform_response: str, prompt: str, create_pr: bool, background: bool = False) -> dict:
+    """
+    Parse a completed generation, then save it and optionally open a PR.
+    
+    With background=True the save/PR step is handed to the background
+    executor and the result carries a job_id for /api/jobs/<job_id>.
+    """
+    # Parse the response into files
+    terraform_blocks = parse_terraform_blocks(terraform_response)
+    
+    if background:
+        return {
+            "success": True,
+            "terraform_code": terraform_response,
+            "files": terraform_blocks,
+            "job_id": submit_job(persist_and_pr, terraform_blocks, prompt, create_pr),
+            "message": "✅ Terraform code generated successfully. Saving and PR creation are running in the background."
+        }
+    
+    persisted = persist_and_pr(terraform_blocks, prompt, create_pr)
+    
+    # Build response message
+    if persisted['pr_url']:
+        message = f"✅ Terraform code generated and PR created for review."
+    else:
+        message = f"✅ Terraform code generated successfully."
+    
+    return {
+        "success": True,
+        "terraform_code": terraform_response,
+        "files": terraform_blocks,
+        "saved_path": persisted['saved_path'],
+        "pr_url": persisted['pr_url'],
+        "pr_number": persisted['pr_number'],
+        "message": message
+    }
+
+
+def stream_generation(messages: list, max_tokens: int, prompt: str, create_pr: bool, cache_key: bytes):
+    """
+    Server-Sent Events generator for /api/generate with "stream": true.
+    
+    Emits a "delta" event per token chunk, then a single "done" event carrying
+    the same JSON body the non-streaming endpoint returns. If the output hits
+    the token budget, a "retry" event tells the client to discard the deltas
+    so far and the generation restarts with MAX_COMPLETION_TOKENS. Failures,
+    including generations that still do not complete, are sent as an "error"
+    event using the usual {"success": false, "error": ...} shape.
+    """
+    try:
+        cached = get_cached_generation(cache_key)
+        if cached is not None:
+            buf, finish_reason = [cached], "stop"
+            yield f"event: delta\ndata: {app.json.dumps({'content': cached})}\n\n"
+        
+        while cached is None:
+            buf, finish_reason = [], None
+            for _, delta, reason in completion_chunks(messages, max_tokens):
+                if delta:
+                    buf.append(delta)
+                    yield f"event: delta\ndata: {app.json.dumps({'content': delta})}\n\n"
+                finish_reason = reason or finish_reason
+            
+            if finish_reason != "length" or max_tokens >= MAX_COMPLETION_TOKENS:
+                break
+            logger.warning("⚠️ Completion truncated at max_tokens=%d, retrying with %d", max_tokens, MAX_COMPLETION_TOKENS)
+            max_tokens = MAX_COMPLETION_TOKENS
+            yield f"event: retry\ndata: {app.json.dumps({'reason': 'length', 'max_tokens': max_tokens})}\n\n"
+        
+        if finish_reason != "stop":
+            yield f"event: error\ndata: {app.json.dumps({'success': False, 'error': incomplete_generation_error(finish_reason)})}\n\n"
+            return
+        
+        terraform_response = ''.join(buf)
+        if cached is None:
+            cache_generation(cache_key, terraform_response, finish_reason)
+        
+        result = finish_generation(terraform_response, prompt, create_pr)
+        result["cache"] = "HIT" if cached is not None else "MISS"
+        yield f"event: done\ndata: {app.json.dumps(result)}\n\n"
+        
+    except Exception as e:
+        logger.exception("⚠️ Streaming generation failed")
+        yield f"event: error\ndata: {app.json.dumps({'success': False, 'error': str(e)})}\n\n"
+
+
 # =============================================================================
 # API ENDPOINTS
 # =============================================================================
@@ -308,8 +798,21 @@ def generate_terraform():
         "prompt": "Create a storage account with blob container",
         "location": "eastus",
         "resource_group_name": "my-rg",
-        "create_pr": true
+        "create_pr": true,
+        "stream": false,
+        "variants": 1
     }
+    
+    "variants" (1-4) asks the model for that many alternative configurations
+    in one call. The first is saved/PR'd as usual; the others are returned in
+    "variants" so one of them can be committed via /api/copilot/generate.
+    
+    By default the files are saved and the PR is created in the background;
+    the response carries a job_id to poll at /api/jobs/<job_id>. Pass
+    ?sync=1 to wait for them and get saved_path/pr_url directly.
+    
+    With "stream": true the response is a text/event-stream of "delta"
+    events followed by a final "done" (or "error") event.
     """
     try:
         data = request.get_json()
@@ -330,66 +833,84 @@ def generate_terraform():
         location = data.get('location', 'eastus')
         resource_group_name = data.get('resource_group_name', '')
         create_pr = data.get('create_pr', True)
+        variants = data.get('variants', 1)
+        
+        if not isinstance(variants, int) or isinstance(variants, bool) or not 1 <= variants <= MAX_VARIANTS:
+            return jsonify({
+                "success": False,
+                "error": f"variants must be an integer between 1 and {MAX_VARIANTS}"
+            }), 400
+        
+        if variants > 1 and data.get('stream'):
+            return jsonify({
+                "success": False,
+                "error": "stream is not supported together with variants"
+            }), 400
         
         # Enhance prompt with context
         enhanced_prompt = f"{prompt}\n\nLocation: {location}"
         if resource_group_name:
             enhanced_prompt += f"\nResource Group: {resource_group_name}"
         
-        print(f"\n{'='*60}")
-        print("🤖 Azure OpenAI - Terraform Generation Request")
-        print(f"{'='*60}")
-        print(f"Prompt: {prompt}")
-        print(f"Location: {location}")
-        print(f"{'='*60}\n")
-        
-        # Call Azure OpenAI
-        response = openai_client.chat.completions.create(
-            model=AZURE_OPENAI_DEPLOYMENT,
-            messages=[
-                {"role": "system", "content": TERRAFORM_SYSTEM_PROMPT},
-                {"role": "user", "content": enhanced_prompt}
-            ],
-            temperature=0.3,
-            max_tokens=4000
-        )
+        logger.info("🤖 Azure OpenAI - Terraform Generation Request | Prompt: %s | Location: %s", prompt, location)
         
-        terraform_response = response.choices[0].message.content
+        messages = [
+            {"role": "system", "content": TERRAFORM_SYSTEM_PROMPT},
+            {"role": "user", "content": enhanced_prompt}
+        ]
         
-        # Parse the response into files
-        terraform_blocks = parse_terraform_blocks(terraform_response)
+        cache_key = generation_cache_key(prompt, location, resource_group_name)
+        max_tokens = estimate_max_tokens(prompt)
         
-        # Save to disk
-        saved_path = save_terraform_files(terraform_blocks, prompt)
-        print(f"💾 Saved to: {saved_path}")
+        # Stream tokens to the client as Server-Sent Events if requested
+        if data.get('stream'):
+            return Response(
+                stream_with_context(stream_generation(messages, max_tokens, prompt, create_pr, cache_key)),
+                mimetype='text/event-stream',
+                headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+            )
         
-        # Create PR if requested
-        pr_result = {}
-        if create_pr:
-            pr_result = create_github_pr(terraform_blocks, prompt)
-            if pr_result.get('success'):
-                print(f"✅ PR created: {pr_result['pr_url']}")
+        # Saving and PR creation run in the background unless ?sync=1
+        background = request.args.get('sync') not in ('1', 'true')
         
-        # Build response message
-        if pr_result.get('success'):
-            message = f"✅ Terraform code generated and PR created for review."
-        else:
-            message = f"✅ Terraform code generated successfully."
+        # Alternatives are requested together and never served from the cache
+        if variants > 1:
+            completions = complete(messages, max_tokens, variants)
+            if completions[0][1] != "stop":
+                return jsonify({
+                    "success": False,
+                    "error": incomplete_generation_error(completions[0][1])
+                }), 500
+            
+            # Alternatives that did not complete are left out
+            responses = [text for text, finish_reason in completions if finish_reason == "stop"]
+            result = finish_generation(responses[0], prompt, create_pr, background)
+            result["variants"] = [
+                {"terraform_code": r, "files": parse_terraform_blocks(r)} for r in responses[1:]
+            ]
+            result["cache"] = "BYPASS"
+            return jsonify(result)
         
-        return jsonify({
-            "success": True,
-            "terraform_code": terraform_response,
-            "files": terraform_blocks,
-            "saved_path": saved_path,
-            "pr_url": pr_result.get('pr_url'),
-            "pr_number": pr_result.get('pr_number'),
-            "message": message
-        })
+        # Reuse a previous identical generation, otherwise call Azure OpenAI
+        terraform_response = get_cached_generation(cache_key)
+        cache_status = "HIT" if terraform_response is not None else "MISS"
+        if terraform_response is None:
+            [(terraform_response, finish_reason)] = complete(messages, max_tokens)
+            if finish_reason != "stop":
+                return jsonify({
+                    "success": False,
+                    "error": incomplete_generation_error(finish_reason)
+                }), 500
+            cache_generation(cache_key, terraform_response, finish_reason)
         
+        result = finish_generation(terraform_response, prompt, create_pr, background)
+        result["cache"] = cache_status
+        return jsonify(result)
+        
+    except HTTPException:
+        raise
     except Exception as e:
-        print(f"⚠️ Error: {e}")
-        import traceback
-        traceback.print_exc()
+        logger.exception("⚠️ Error: %s", e)
         return jsonify({
             "success": False,
             "error": str(e)
@@ -416,6 +937,9 @@ def copilot_generate():
         "pr_url": "https://github.com/...",
         "message": "..."
     }
+    
+    With ?async=1 the response returns immediately with a job_id instead
+    of saved_path/pr_url; poll /api/jobs/<job_id> for the result.
     """
     try:
         data = request.get_json()
@@ -427,54 +951,58 @@ def copilot_generate():
             }), 400
         
         terraform_code = data['terraform_code']
+        
+        if len(terraform_code) > MAX_TERRAFORM_CODE_CHARS:
+            return jsonify({
+                "success": False,
+                "error": f"terraform_code too large (max {MAX_TERRAFORM_CODE_CHARS} characters)"
+            }), 413
+        
         description = data.get('description', 'Infrastructure deployment')
         location = data.get('location', 'eastus')
         create_pr = data.get('create_pr', True)
         
-        print(f"\n{'='*60}")
-        print("🤖 Copilot Studio - Commit Terraform Request")
-        print(f"{'='*60}")
-        print(f"Description: {description}")
-        print(f"Location: {location}")
-        print(f"Code length: {len(terraform_code)} chars")
-        print(f"{'='*60}\n")
+        logger.info(
+            "🤖 Copilot Studio - Commit Terraform Request | Description: %s | Location: %s | Code length: %d chars",
+            description, location, len(terraform_code)
+        )
         
         # Parse the Terraform code into files
         terraform_blocks = parse_terraform_blocks(terraform_code)
         
-        # Save to disk
-        saved_path = save_terraform_files(terraform_blocks, description)
-        print(f"💾 Saved to: {saved_path}")
+        # Saving and PR creation can be moved off the request thread with ?async=1
+        if request.args.get('async') in ('1', 'true'):
+            return jsonify({
+                "success": True,
+                "files": terraform_blocks,
+                "job_id": submit_job(persist_and_pr, terraform_blocks, description, create_pr),
+                "message": "✅ Terraform code received. Saving and PR creation are running in the background."
+            })
         
-        # Create PR if requested
-        pr_result = {}
-        if create_pr:
-            pr_result = create_github_pr(terraform_blocks, description)
-            if pr_result.get('success'):
-                print(f"✅ PR created: {pr_result['pr_url']}")
+        persisted = persist_and_pr(terraform_blocks, description, create_pr)
         
         # Build response message
-        if pr_result.get('success'):
+        if persisted['pr_url']:
             message = f"✅ Terraform code committed and PR created for review."
         else:
             message = f"✅ Terraform code saved successfully."
-            if pr_result.get('error'):
-                message += f" (GitHub: {pr_result['error']})"
+            if persisted['pr_error']:
+                message += f" (GitHub: {persisted['pr_error']})"
         
         return jsonify({
             "success": True,
             "files": terraform_blocks,
-            "saved_path": saved_path,
-            "pr_url": pr_result.get('pr_url'),
-            "pr_number": pr_result.get('pr_number'),
-            "branch_name": pr_result.get('branch_name'),
+            "saved_path": persisted['saved_path'],
+            "pr_url": persisted['pr_url'],
+            "pr_number": persisted['pr_number'],
+            "branch_name": persisted['branch_name'],
             "message": message
         })
         
+    except HTTPException:
+        raise
     except Exception as e:
-        print(f"⚠️ Error: {e}")
-        import traceback
-        traceback.print_exc()
+        logger.exception("⚠️ Error: %s", e)
         return jsonify({
             "success": False,
             "error": str(e)
@@ -497,20 +1025,12 @@ def copilot_pr_status(pr_number):
         if not GITHUB_TOKEN or not GITHUB_REPO_URL:
             return jsonify({"error": "GitHub not configured"}), 500
         
-        match = re.match(r'https://github\.com/([^/]+)/([^/\.]+)', GITHUB_REPO_URL)
-        if not match:
+        if not GITHUB_OWNER:
             return jsonify({"error": "Invalid repo configuration"}), 500
         
-        owner, repo = match.groups()
-        headers = {
-            "Authorization": f"Bearer {GITHUB_TOKEN}",
-            "Accept": "application/vnd.github.v3+json"
-        }
-        
         # Get PR info
-        pr_response = requests.get(
-            f"https://api.github.com/repos/{owner}/{repo}/pulls/{pr_number}",
-            headers=headers
+        pr_response = github_session.get(
+            f"https://api.github.com/repos/{GITHUB_OWNER}/{GITHUB_REPO}/pulls/{pr_number}"
         )
         
         if pr_response.status_code != 200:
@@ -545,6 +1065,46 @@ def copilot_pr_status(pr_number):
         return jsonify({"error": str(e)}), 500
 
 
+@app.route('/api/jobs/<job_id>', methods=['GET'])
+def job_status(job_id):
+    """
+    Check a background save/PR job started by a generate endpoint.
+    
+    Response:
+    {
+        "success": true,
+        "job_id": "...",
+        "status": "running|done|failed",
+        "saved_path": "...",
+        "pr_url": "https://github.com/..."
+    }
+    """
+    with background_jobs_lock:
+        future = background_jobs.get(job_id)
+    
+    if future is None:
+        return jsonify({"success": False, "error": "Job not found"}), 404
+    
+    if not future.done():
+        return jsonify({"success": True, "job_id": job_id, "status": "running"})
+    
+    error = future.exception()
+    if error:
+        return jsonify({
+            "success": False,
+            "job_id": job_id,
+            "status": "failed",
+            "error": str(error)
+        })
+    
+    return jsonify({
+        "success": True,
+        "job_id": job_id,
+        "status": "done",
+        **future.result()
+    })
+
+
 @app.route('/api/templates', methods=['GET'])
 def list_templates():
     """
@@ -596,14 +1156,34 @@ def list_templates():
     })
 
 
+@app.errorhandler(RequestEntityTooLarge)
+def request_too_large(e):
+    """Reject oversized request bodies with the usual JSON error shape."""
+    return jsonify({
+        "success": False,
+        "error": f"Request body too large (max {MAX_REQUEST_BYTES} bytes)"
+    }), 413
+
+
+@app.errorhandler(HTTPException)
+def api_http_error(e):
+    """Report client errors on the API (bad JSON, wrong method, ...) as JSON."""
+    if e.code is None or e.code < 400 or not request.path.startswith('/api/'):
+        return e
+    return jsonify({
+        "success": False,
+        "error": e.description
+    }), e.code
+
+
 # =============================================================================
 # WEB INTERFACE
 # =============================================================================
 
 @app.route('/')
 def index():
-    """Simple web interface for testing."""
-    return render_template('index.html')
+    """Simple web interface for testing (static file, served with an ETag)."""
+    return app.send_static_file('index.html')
 
 
 # =============================================================================
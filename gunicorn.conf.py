@@ -0,0 +1,22 @@
+"""
+Gunicorn configuration for the Copilot Terraform Agent.
+Run with: gunicorn -c gunicorn.conf.py app:app
+"""
+
+import os
+
+bind = f"{os.getenv('FLASK_HOST', '0.0.0.0')}:{os.getenv('FLASK_PORT', '5001')}"
+
+# Requests mostly wait on Azure OpenAI / GitHub, so threads give the concurrency.
+# Background jobs and the generation cache live in process memory, so keep a
+# single worker process unless WEB_CONCURRENCY says otherwise.
+workers = int(os.getenv("WEB_CONCURRENCY", 1))
+worker_class = "gthread"
+threads = int(os.getenv("GUNICORN_THREADS", 16))
+
+# Generation can take well over the 30s default
+timeout = 120
+keepalive = 5
+
+accesslog = "-"
+errorlog = "-"